@@ -1,5 +1,5 @@
 from functools import partial
-from typing import Callable, Optional, Sequence, Union
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
 import cached_conv as cc
 import gin
@@ -9,7 +9,8 @@ import torch.nn as nn
 from torch.nn.utils import weight_norm
 from torchaudio.transforms import Spectrogram
 
-from .core import amp_to_impulse_response, fft_convolve, mod_sigmoid
+from .core import (amp_to_impulse_response, compile_module, fft_convolve,
+                   mod_sigmoid, remove_weight_norm)
 
 
 @gin.configurable
@@ -22,10 +23,15 @@ def normalization(module: nn.Module, mode: str = 'identity'):
         raise Exception(f'Normalization mode {mode} not supported')
 
 
+@torch.jit.script
+def sample_norm(x):
+    return x / torch.norm(x, 2, 1, keepdim=True)
+
+
 class SampleNorm(nn.Module):
 
     def forward(self, x):
-        return x / torch.norm(x, 2, 1, keepdim=True)
+        return sample_norm(x)
 
 
 class Residual(nn.Module):
@@ -159,8 +165,10 @@ class ResidualStack(nn.Module):
         self.cumulative_delay = self.net.cumulative_delay
 
     def forward(self, x):
-        x = self.net(x)
-        x = torch.stack(x, 0).sum(0)
+        branches = self.net(x)
+        x = branches[0]
+        for i in range(1, len(branches)):
+            x = x + branches[i]
         return x
 
 
@@ -195,10 +203,67 @@ class UpsampleLayer(nn.Module):
         return self.net(x)
 
 
+@torch.jit.script
+def noise_amplitudes(x, n_bands: int):
+    amp = mod_sigmoid(x - 5)
+    amp = amp.permute(0, 2, 1)
+    return amp.reshape(amp.shape[0], amp.shape[1], n_bands,
+                       amp.shape[2] // n_bands)
+
+
+@torch.jit.script
+def read_noise_buffer(buffer, pointer: List[int], shape: List[int]):
+    # contiguous reads of the ring buffer, the host-side pointer is updated
+    # in place
+    numel = 1
+    for size in shape:
+        numel *= size
+    buffer_size = buffer.shape[0]
+    if numel > buffer_size:
+        raise RuntimeError("noise buffer holds " + str(buffer_size) +
+                           " samples, " + str(numel) + " requested")
+    start = pointer[0]
+    end = start + numel
+    if end <= buffer_size:
+        noise = buffer.narrow(0, start, numel)
+    else:
+        noise = torch.cat([
+            buffer.narrow(0, start, buffer_size - start),
+            buffer.narrow(0, 0, end - buffer_size),
+        ])
+    pointer[0] = end % buffer_size
+    return noise.reshape(shape)
+
+
+@torch.jit.script
+def filtered_noise(x,
+                   target_size: int,
+                   n_bands: int,
+                   window: Optional[torch.Tensor] = None,
+                   noise_buffer: Optional[torch.Tensor] = None,
+                   noise_pointer: Optional[List[int]] = None):
+    amp = noise_amplitudes(x, n_bands)
+
+    ir = amp_to_impulse_response(amp, target_size, window)
+    if noise_buffer is not None and noise_pointer is not None:
+        noise = read_noise_buffer(noise_buffer, noise_pointer, ir.shape)
+    else:
+        noise = torch.rand_like(ir) * 2 - 1
+
+    noise = fft_convolve(noise, ir).permute(0, 2, 1, 3)
+    noise = noise.reshape(noise.shape[0], noise.shape[1], -1)
+    return noise
+
+
 @gin.configurable
 class NoiseGenerator(nn.Module):
 
-    def __init__(self, in_size, data_size, ratios, noise_bands):
+    def __init__(self,
+                 in_size,
+                 data_size,
+                 ratios,
+                 noise_bands,
+                 noise_buffer_size: int = 0):
         super().__init__()
         net = []
         channels = [in_size] * len(ratios) + [data_size * noise_bands]
@@ -222,22 +287,47 @@ class NoiseGenerator(nn.Module):
         self.cumulative_delay = self.net.cumulative_delay * int(
             np.prod(ratios))
 
+        # kept as a buffer for checkpoint compatibility, forward uses the
+        # python int so that shapes stay static
         self.register_buffer(
             "target_size",
             torch.tensor(np.prod(ratios)).long(),
         )
+        self.ir_size = int(np.prod(ratios))
+        self.register_buffer(
+            "ir_window",
+            torch.roll(torch.hann_window(2 * (noise_bands - 1)),
+                       noise_bands - 1),
+            persistent=False,
+        )
 
-    def forward(self, x):
-        amp = mod_sigmoid(self.net(x) - 5)
-        amp = amp.permute(0, 2, 1)
-        amp = amp.reshape(amp.shape[0], amp.shape[1], self.data_size, -1)
-
-        ir = amp_to_impulse_response(amp, self.target_size)
-        noise = torch.rand_like(ir) * 2 - 1
+        # optional ring buffer of pre-drawn uniform noise, read at a
+        # host-side pointer instead of sampling new noise at each call. it
+        # must hold at least the noise of one call
+        self.use_noise_buffer = noise_buffer_size > 0
+        self.register_buffer(
+            "noise_buffer",
+            torch.empty(noise_buffer_size).uniform_(-1, 1),
+            persistent=False,
+        )
+        self.noise_pointer = [0]
 
-        noise = fft_convolve(noise, ir).permute(0, 2, 1, 3)
-        noise = noise.reshape(noise.shape[0], noise.shape[1], -1)
-        return noise
+    def forward(self, x):
+        if self.use_noise_buffer:
+            return filtered_noise(
+                self.net(x),
+                self.ir_size,
+                self.data_size,
+                window=self.ir_window,
+                noise_buffer=self.noise_buffer,
+                noise_pointer=self.noise_pointer,
+            )
+        return filtered_noise(
+            self.net(x),
+            self.ir_size,
+            self.data_size,
+            window=self.ir_window,
+        )
 
 
 class NoiseGeneratorV2(nn.Module):
@@ -251,6 +341,7 @@ class NoiseGeneratorV2(nn.Module):
         noise_bands: int,
         n_channels: int = 1,
         activation: Callable[[int], nn.Module] = lambda dim: nn.LeakyReLU(.2),
+        noise_buffer_size: int = 0,
     ):
         super().__init__()
         net = []
@@ -274,22 +365,47 @@ class NoiseGeneratorV2(nn.Module):
         self.net = nn.Sequential(*net)
         self.data_size = data_size
 
+        # kept as a buffer for checkpoint compatibility, forward uses the
+        # python int so that shapes stay static
         self.register_buffer(
             "target_size",
             torch.tensor(np.prod(ratios)).long(),
         )
+        self.ir_size = int(np.prod(ratios))
+        self.register_buffer(
+            "ir_window",
+            torch.roll(torch.hann_window(2 * (noise_bands - 1)),
+                       noise_bands - 1),
+            persistent=False,
+        )
 
-    def forward(self, x):
-        amp = mod_sigmoid(self.net(x) - 5)
-        amp = amp.permute(0, 2, 1)
-        amp = amp.reshape(amp.shape[0], amp.shape[1], self.n_channels * self.data_size, -1)
-
-        ir = amp_to_impulse_response(amp, self.target_size)
-        noise = torch.rand_like(ir) * 2 - 1
+        # optional ring buffer of pre-drawn uniform noise, read at a
+        # host-side pointer instead of sampling new noise at each call. it
+        # must hold at least the noise of one call
+        self.use_noise_buffer = noise_buffer_size > 0
+        self.register_buffer(
+            "noise_buffer",
+            torch.empty(noise_buffer_size).uniform_(-1, 1),
+            persistent=False,
+        )
+        self.noise_pointer = [0]
 
-        noise = fft_convolve(noise, ir).permute(0, 2, 1, 3)
-        noise = noise.reshape(noise.shape[0], noise.shape[1], -1)
-        return noise
+    def forward(self, x):
+        if self.use_noise_buffer:
+            return filtered_noise(
+                self.net(x),
+                self.ir_size,
+                self.n_channels * self.data_size,
+                window=self.ir_window,
+                noise_buffer=self.noise_buffer,
+                noise_pointer=self.noise_pointer,
+            )
+        return filtered_noise(
+            self.net(x),
+            self.ir_size,
+            self.n_channels * self.data_size,
+            window=self.ir_window,
+        )
 
 
 class GRU(nn.Module):
@@ -305,10 +421,34 @@ class GRU(nn.Module):
         self.register_buffer("gru_state", torch.tensor(0))
         self.enabled = True
 
+        # in streaming mode the hidden state spans the full cached batch so
+        # that every call runs with the same static shapes
+        self.streaming = cc.USE_BUFFER_CONV
+        self.register_buffer(
+            "hidden_state",
+            torch.zeros(num_layers, cc.MAX_BATCH_SIZE, latent_size),
+            persistent=False,
+        )
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         if not self.enabled: return x
         x = x.permute(0, 2, 1)
-        x = self.gru(x)[0]
+        if self.streaming:
+            # padded to the batch size the state was allocated with, which
+            # may differ from the current cc.MAX_BATCH_SIZE
+            batch_size = x.shape[0]
+            max_batch_size = self.hidden_state.shape[1]
+            if batch_size > max_batch_size:
+                raise RuntimeError(
+                    f"GRU streaming state holds {max_batch_size} examples, "
+                    f"got a batch of {batch_size}")
+            x = nn.functional.pad(
+                x, (0, 0, 0, 0, 0, max_batch_size - batch_size))
+            x, state = self.gru(x, self.hidden_state)
+            self.hidden_state.copy_(state.detach())
+            x = x[:batch_size]
+        else:
+            x = self.gru(x)[0]
         x = x.permute(0, 2, 1)
         return x
 
@@ -319,6 +459,15 @@ class GRU(nn.Module):
         self.enabled = True
 
 
+@torch.jit.script
+def final_mix(waveform, loudness, noise: Optional[torch.Tensor] = None):
+    # mod_sigmoid is inlined so that the whole mix fuses into one kernel
+    waveform = torch.tanh(waveform) * (2 * torch.sigmoid(loudness)**2.3 + 1e-7)
+    if noise is not None:
+        waveform = waveform + noise
+    return waveform
+
+
 class Generator(nn.Module):
 
     def __init__(
@@ -331,6 +480,7 @@ class Generator(nn.Module):
         use_noise,
         n_channels: int = 1,
         recurrent_layer: Optional[Callable[[], nn.Module]] = None,
+        compile: bool = False,
     ):
         super().__init__()
         net = [
@@ -396,6 +546,10 @@ class Generator(nn.Module):
 
         self.register_buffer("warmed_up", torch.tensor(0))
 
+        if compile:
+            compile_module(self.net)
+            compile_module(self.synth)
+
     def set_warmed_up(self, state: bool):
         state = torch.tensor(int(state), device=self.warmed_up.device)
         self.warmed_up = state
@@ -403,22 +557,49 @@ class Generator(nn.Module):
     def forward(self, x):
         x = self.net(x)
 
+        noise: Optional[torch.Tensor] = None
         if self.use_noise:
             waveform, loudness, noise = self.synth(x)
         else:
             waveform, loudness = self.synth(x)
-            noise = torch.zeros_like(waveform)
-
-        if self.loud_stride != 1:
-            loudness = loudness.repeat_interleave(self.loud_stride)
-        loudness = loudness.reshape(x.shape[0], 1, -1)
-
-        waveform = torch.tanh(waveform) * mod_sigmoid(loudness)
 
-        if self.warmed_up and self.use_noise:
-            waveform = waveform + noise
+        return self.combine(waveform, loudness, noise)
 
-        return waveform
+    def combine(self, waveform, loudness, noise: Optional[torch.Tensor]):
+        if self.loud_stride != 1:
+            batch_size, n_loud, n_frames = loudness.shape
+            loudness = loudness.unsqueeze(-1).expand(
+                batch_size,
+                n_loud,
+                n_frames,
+                self.loud_stride,
+            )
+        loudness = loudness.reshape(waveform.shape[0], 1, -1)
+
+        if not (self.warmed_up and self.use_noise):
+            noise = None
+
+        return final_mix(waveform, loudness, noise)
+
+
+@torch.no_grad()
+def fold_batch_norm(conv: nn.Conv1d, bn: nn.BatchNorm1d):
+    """
+    folds the running statistics and affine transform of bn into the conv
+    preceding it
+    """
+    remove_weight_norm(conv)
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+
+    conv.weight.mul_(scale.reshape(-1, 1, 1))
+    if conv.bias is None:
+        conv.bias = nn.Parameter(shift.clone())
+    else:
+        conv.bias.mul_(scale).add_(shift)
 
 
 class Encoder(nn.Module):
@@ -435,7 +616,8 @@ class Encoder(nn.Module):
         n_channels: int = 1,
         recurrent_layer: Optional[Callable[[], nn.Module]] = None,
         # retro-compatiblity
-        spectrogram = None
+        spectrogram = None,
+        compile: bool = False,
     ):
         super().__init__()
         data_size = data_size or n_channels
@@ -498,6 +680,17 @@ class Encoder(nn.Module):
         self.net = cc.CachedSequential(*net)
         self.cumulative_delay = self.net.cumulative_delay
 
+        if compile:
+            compile_module(self.net)
+
+    def fuse_for_inference(self):
+        for i in range(1, len(self.net)):
+            conv, bn = self.net[i - 1], self.net[i]
+            if isinstance(bn, nn.BatchNorm1d) and isinstance(conv, nn.Conv1d):
+                fold_batch_norm(conv, bn)
+                self.net[i] = nn.Identity()
+        return self
+
     def forward(self, x):
         z = self.net(x)
         return z
@@ -527,7 +720,8 @@ class EncoderV2(nn.Module):
         n_channels: int = 1,
         activation: Callable[[int], nn.Module] = lambda dim: nn.LeakyReLU(.2),
         adain: Optional[Callable[[int], nn.Module]] = None,
-        spectrogram = None
+        spectrogram = None,
+        compile: bool = False,
     ) -> None:
         super().__init__()
         dilations_list = normalize_dilations(dilations, ratios)
@@ -590,10 +784,22 @@ class EncoderV2(nn.Module):
             net.append(recurrent_layer(latent_size * n_out))
 
         self.net = cc.CachedSequential(*net)
+        self.bf16 = False
+
+        if compile:
+            compile_module(self.net)
+
+    def to_bf16(self):
+        self.net.to(torch.bfloat16)
+        self.bf16 = True
+        return self
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        dtype = x.dtype
+        if self.bf16:
+            x = x.to(torch.bfloat16)
         x = self.net(x)
-        return x
+        return x.to(dtype)
 
 
 class GeneratorV2(nn.Module):
@@ -613,6 +819,7 @@ class GeneratorV2(nn.Module):
         noise_module: Optional[NoiseGeneratorV2] = None,
         activation: Callable[[int], nn.Module] = lambda dim: nn.LeakyReLU(.2),
         adain: Optional[Callable[[int], nn.Module]] = None,
+        compile: bool = False,
     ) -> None:
         super().__init__()
         if data_size is None:
@@ -623,7 +830,7 @@ class GeneratorV2(nn.Module):
         ratios = ratios[::-1]
 
         if keep_dim:
-            num_channels = np.prod(ratios) * capacity
+            num_channels = int(np.prod(ratios)) * capacity
         else:
             num_channels = 2**len(ratios) * capacity
 
@@ -692,14 +899,31 @@ class GeneratorV2(nn.Module):
         self.net = cc.CachedSequential(*net)
 
         self.amplitude_modulation = amplitude_modulation
+        self.bf16 = False
+
+        if compile:
+            compile_module(self.net)
+
+    def to_bf16(self):
+        # the noise module is kept in full precision as ffts do not
+        # support bfloat16
+        self.net.to(torch.bfloat16)
+        if self.waveform_module is not None:
+            self.waveform_module.to(torch.bfloat16)
+        self.bf16 = True
+        return self
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        dtype = x.dtype
+        if self.bf16:
+            x = x.to(torch.bfloat16)
+
         x = self.net(x)
 
         noise = 0.
 
         if self.noise_module is not None:
-            noise = self.noise_module(x)
+            noise = self.noise_module(x.to(dtype))
             x = self.waveform_module(x)
 
         if self.amplitude_modulation:
@@ -708,12 +932,24 @@ class GeneratorV2(nn.Module):
 
         x = x + noise
 
-        return torch.tanh(x)
+        return torch.tanh(x).to(dtype)
 
     def set_warmed_up(self, state: bool):
         pass
 
 
+@torch.jit.script
+def sample_and_kl(mean, scale,
+                  beta: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    std = nn.functional.softplus(scale) + 1e-4
+    logvar = 2 * torch.log(std)
+
+    z = torch.randn_like(mean) * std + mean
+    kl = (mean * mean + std * std - logvar - 1).sum(1).mean()
+
+    return z, beta * kl
+
+
 class VariationalEncoder(nn.Module):
 
     def __init__(self, encoder, beta: float = 1.0, n_channels=1):
@@ -724,14 +960,7 @@ class VariationalEncoder(nn.Module):
 
     def reparametrize(self, z):
         mean, scale = z.chunk(2, 1)
-        std = nn.functional.softplus(scale) + 1e-4
-        var = std * std
-        logvar = torch.log(var)
-
-        z = torch.randn_like(mean) * std + mean
-        kl = (mean * mean + var - logvar - 1).sum(1).mean()
-
-        return z, self.beta * kl
+        return sample_and_kl(mean, scale, self.beta)
 
     def set_warmed_up(self, state: bool):
         state = torch.tensor(int(state), device=self.warmed_up.device)
@@ -745,6 +974,19 @@ class VariationalEncoder(nn.Module):
         return z
 
 
+@torch.jit.script
+def add_noise_channels(z, noise_augmentation: int):
+    # sampled directly on the latent device instead of copied from the host
+    noise = torch.randn(
+        z.shape[0],
+        noise_augmentation,
+        z.shape[-1],
+        dtype=z.dtype,
+        device=z.device,
+    )
+    return torch.cat([z, noise], 1)
+
+
 class WasserteinEncoder(nn.Module):
 
     def __init__(
@@ -759,7 +1001,12 @@ class WasserteinEncoder(nn.Module):
         self.noise_augmentation = noise_augmentation
 
     def compute_mean_kernel(self, x, y):
-        kernel_input = (x[:, None] - y[None]).pow(2).mean(2) / x.shape[-1]
+        # pairwise squared distances as |x|^2 + |y|^2 - 2xy, clamped since
+        # the expansion can go slightly negative
+        xx = x.pow(2).sum(-1, keepdim=True)
+        yy = y.pow(2).sum(-1, keepdim=True).t()
+        sq_dist = (xx + yy - 2 * x @ y.t()).clamp_min(0)
+        kernel_input = sq_dist / x.shape[-1]**2
         return torch.exp(-kernel_input).mean()
 
     def compute_mmd(self, x, y):
@@ -774,9 +1021,7 @@ class WasserteinEncoder(nn.Module):
         reg = self.compute_mmd(z_reshaped, torch.randn_like(z_reshaped))
 
         if self.noise_augmentation:
-            noise = torch.randn(z.shape[0], self.noise_augmentation,
-                                z.shape[-1]).type_as(z)
-            z = torch.cat([z, noise], 1)
+            z = add_noise_channels(z, self.noise_augmentation)
 
         return z, reg.mean()
 
@@ -812,12 +1057,10 @@ class DiscreteEncoder(nn.Module):
         if self.enabled:
             z, diff, _ = self.rvq(z)
         else:
-            diff = torch.zeros_like(z).mean()
+            diff = z.new_zeros(())
 
         if self.noise_augmentation:
-            noise = torch.randn(z.shape[0], self.noise_augmentation,
-                                z.shape[-1]).type_as(z)
-            z = torch.cat([z, noise], 1)
+            z = add_noise_channels(z, self.noise_augmentation)
 
         return z, diff
 
@@ -838,7 +1081,7 @@ class SphericalEncoder(nn.Module):
 
     def reparametrize(self, z):
         norm_z = z / torch.norm(z, p=2, dim=1, keepdim=True)
-        reg = torch.zeros_like(z).mean()
+        reg = z.new_zeros(())
         return norm_z, reg
 
     def set_warmed_up(self, state: bool):
@@ -1,8 +1,11 @@
+import contextlib
 import json
+import math
 import os
+from functools import partial
 from pathlib import Path
 from random import random
-from typing import Callable, Optional, Sequence, Union
+from typing import Any, Callable, List, Optional, Sequence, Union
 
 import GPUtil as gpu
 import librosa as li
@@ -15,8 +18,152 @@ import torch.nn as nn
 import torchaudio
 from einops import rearrange
 from scipy.signal import lfilter
+from torch.utils.checkpoint import checkpoint
 
+USE_TORCH_COMPILE = True
 
+
+def use_torch_compile(state: bool):
+    global USE_TORCH_COMPILE
+    USE_TORCH_COMPILE = state
+
+
+def compile_module(module: nn.Module,
+                   mode: str = "reduce-overhead",
+                   dynamic: bool = False) -> nn.Module:
+    """
+    compiles the forward method of a module in place, leaving its state dict
+    untouched. input shapes must stay fixed between calls for the captured
+    graph to be reused.
+    """
+    if not USE_TORCH_COMPILE or not hasattr(torch, "compile"):
+        return module
+    module.forward = torch.compile(module.forward, mode=mode, dynamic=dynamic)
+    return module
+
+
+def autocast_disabled(x: torch.Tensor):
+    """
+    context running its body outside autocast. older torch versions reject
+    autocast contexts on devices other than cuda and cpu, where autocast
+    cannot be enabled anyway
+    """
+    if x.device.type in ("cuda", "cpu"):
+        return torch.autocast(x.device.type, enabled=False)
+    return contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def frozen_batch_norm_stats(modules: Sequence[nn.Module]):
+    """
+    restores the running statistics of every batch norm found in modules
+    when the context exits
+    """
+    norms = [
+        m for module in modules for m in module.modules()
+        if isinstance(m, nn.modules.batchnorm._BatchNorm)
+        and m.track_running_stats
+    ]
+    stats = [(m.running_mean.clone(), m.running_var.clone(),
+              m.num_batches_tracked.clone()) for m in norms]
+    try:
+        yield
+    finally:
+        for m, (mean, var, count) in zip(norms, stats):
+            m.running_mean.copy_(mean)
+            m.running_var.copy_(var)
+            m.num_batches_tracked.copy_(count)
+
+
+def _run_layers(layers: Sequence[nn.Module], x: torch.Tensor) -> torch.Tensor:
+    for layer in layers:
+        x = layer(x)
+    return x
+
+
+def _run_segment(layers: Sequence[nn.Module]):
+    calls = []
+
+    def run(x: torch.Tensor) -> torch.Tensor:
+        # any call after the first is the backward recomputation, which must
+        # not update batch norm statistics a second time
+        if calls:
+            with frozen_batch_norm_stats(layers):
+                return _run_layers(layers, x)
+        calls.append(True)
+        return _run_layers(layers, x)
+
+    return run
+
+
+def checkpoint_sequential(net: nn.Sequential, x: torch.Tensor,
+                          segments: int) -> torch.Tensor:
+    """
+    runs a sequential module as consecutive checkpointed segments, so that
+    only the segment inputs are stored and the activations of a single
+    segment are recomputed at a time during backward
+    """
+    layers = list(net)
+    size = math.ceil(len(layers) / segments)
+    for start in range(0, len(layers), size):
+        x = checkpoint(
+            _run_segment(layers[start:start + size]),
+            x,
+            use_reentrant=False,
+        )
+    return x
+
+
+def enable_gradient_checkpointing(net: nn.Sequential,
+                                  segments: Optional[int] = None):
+    """
+    makes a sequential module checkpoint its forward pass in segments, about
+    the square root of its length by default, while training with autograd
+    enabled. undone by disable_gradient_checkpointing
+    """
+    segments = segments or max(1, int(math.sqrt(len(net))))
+    forward = net.forward
+    # forward patched onto the instance beforehand, e.g. by compile_module
+    net._unchecked_forward = net.__dict__.get("forward")
+
+    def checkpointed_forward(x: torch.Tensor) -> torch.Tensor:
+        if net.training and torch.is_grad_enabled():
+            return checkpoint_sequential(net, x, segments)
+        return forward(x)
+
+    net.forward = checkpointed_forward
+    return net
+
+
+def disable_gradient_checkpointing(net: nn.Sequential):
+    if "_unchecked_forward" not in net.__dict__:
+        return net
+    forward = net.__dict__.pop("_unchecked_forward")
+    if forward is None:
+        del net.forward
+    else:
+        net.forward = forward
+    return net
+
+
+def remove_weight_norm(module: nn.Module) -> nn.Module:
+    """
+    bakes weight normalization into plain weights for every submodule, be it
+    applied through the legacy hook or through parametrizations
+    """
+    for m in list(module.modules()):
+        if hasattr(m, "weight_g"):
+            nn.utils.remove_weight_norm(m)
+        elif nn.utils.parametrize.is_parametrized(m, "weight"):
+            nn.utils.parametrize.remove_parametrizations(
+                m,
+                "weight",
+                leave_parametrized=True,
+            )
+    return module
+
+
+@torch.jit.script
 def mod_sigmoid(x):
     return 2 * torch.sigmoid(x)**2.3 + 1e-7
 
@@ -42,36 +189,67 @@ def pole_to_z_filter(omega, amplitude=.9):
 def random_phase_mangle(x, min_f, max_f, amp, sr):
     angle = random_angle(min_f, max_f, sr)
     b, a = pole_to_z_filter(angle, amp)
+    # float32 coefficients keep lfilter from upcasting float32 signals
+    dtype = np.result_type(np.asarray(x).dtype, np.float32)
+    b = np.asarray(b, dtype=dtype)
+    a = np.asarray(a, dtype=dtype)
     return lfilter(b, a, x)
 
 
-def amp_to_impulse_response(amp, target_size):
+@torch.jit.script
+def amp_to_impulse_response(amp,
+                            target_size: int,
+                            window: Optional[torch.Tensor] = None):
     """
-    transforms frequency amps to ir on the last dimension
+    transforms frequency amps to ir on the last dimension. a precomputed hann
+    window matching the filter size, rolled by half its length, can be given
+    to avoid building it
     """
-    amp = torch.stack([amp, torch.zeros_like(amp)], -1)
-    amp = torch.view_as_complex(amp)
+    # a real spectrum is promoted to complex with a zero imaginary part
     amp = fft.irfft(amp)
 
     filter_size = amp.shape[-1]
+    half_size = filter_size // 2
+
+    if window is None:
+        window = torch.hann_window(filter_size,
+                                   dtype=amp.dtype,
+                                   device=amp.device)
+        window = torch.roll(window, half_size, -1)
 
-    amp = torch.roll(amp, filter_size // 2, -1)
-    win = torch.hann_window(filter_size, dtype=amp.dtype, device=amp.device)
+    # centering the ir, windowing it, padding it and rolling it back is the
+    # same as windowing with a rolled window and splitting the result
+    # around the padding
+    amp = amp * window
 
-    amp = amp * win
+    if target_size < filter_size:
+        amp = torch.roll(amp, half_size, -1)[..., :target_size]
+        return torch.roll(amp, -half_size, -1)
 
-    amp = nn.functional.pad(
-        amp,
-        (0, int(target_size) - int(filter_size)),
-    )
-    amp = torch.roll(amp, -filter_size // 2, -1)
+    shape = list(amp.shape)
+    shape[-1] = target_size
+    ir = amp.new_zeros(shape)
+    ir[..., :half_size] = amp[..., :half_size]
+    ir[..., target_size - half_size:] = amp[..., half_size:]
+    return ir
 
-    return amp
 
-def fft_convolve(signal, kernel):
+@torch.jit.script
+def fft_convolve(signal, kernel, max_direct_size: int = 64):
     """
-    convolves signal by kernel on the last dimension
+    convolves signal by kernel on the last dimension. kernels of the same
+    shape as the signal and at most max_direct_size long are applied with a
+    direct grouped convolution, cheaper than the fft round trip
     """
+    size = kernel.shape[-1]
+    if size <= max_direct_size and signal.shape == kernel.shape:
+        shape = signal.shape
+        signal = signal.reshape(1, -1, size)
+        kernel = kernel.reshape(-1, 1, size).flip(-1)
+        signal = nn.functional.pad(signal, (size - 1, 0))
+        output = nn.functional.conv1d(signal, kernel, groups=kernel.shape[0])
+        return output.reshape(shape)
+
     signal = nn.functional.pad(signal, (0, signal.shape[-1]))
     kernel = nn.functional.pad(kernel, (kernel.shape[-1], 0))
 
@@ -89,6 +267,13 @@ def get_ckpts(folder, name=None):
     return ckpts
 
 
+def get_last_ckpt(folder, name=None):
+    ckpts = map(str, Path(folder).rglob("*.ckpt"))
+    if name:
+        ckpts = filter(lambda e: name in os.path.basename(e), ckpts)
+    return max(ckpts, key=os.path.getmtime, default=None)
+
+
 def get_versions(folder):
     ckpts = map(str, Path(folder).rglob("version_*"))
     ckpts = filter(lambda x: os.path.isdir(x), ckpts)
@@ -97,29 +282,21 @@ def get_versions(folder):
 def search_for_config(folder):
     if os.path.isfile(folder):
         folder = os.path.dirname(folder)
-    configs = list(map(str, Path(folder).rglob("config.gin")))
-    if configs != []:
-        return os.path.abspath(os.path.join(folder, "config.gin"))
-    configs = list(map(str, Path(folder).rglob("../config.gin")))
-    if configs != []:
-        return os.path.abspath(os.path.join(folder, "../config.gin"))
-    configs = list(map(str, Path(folder).rglob("../../config.gin")))
-    if configs != []:
-        return os.path.abspath(os.path.join(folder, "../../config.gin"))
-    else:
-        return None
+    # stops at the first match instead of listing the whole tree
+    for config in ["config.gin", "../config.gin", "../../config.gin"]:
+        if next(Path(folder).rglob(config), None) is not None:
+            return os.path.abspath(os.path.join(folder, config))
+    return None
 
     
 
 def search_for_run(run_path, name=None):
     if run_path is None: return None
     if ".ckpt" in run_path: return run_path
-    ckpts = get_ckpts(run_path)
-    if len(ckpts) != 0:
-        return ckpts[-1]
-    else:
+    ckpt = get_last_ckpt(run_path)
+    if ckpt is None:
         print('No checkpoint found')
-    return None
+    return ckpt
 
 
 def setup_gpu():
@@ -128,11 +305,12 @@ def setup_gpu():
 
 def get_beta_kl(step, warmup, min_beta, max_beta):
     if step > warmup: return max_beta
-    t = step / warmup
-    min_beta_log = np.log(min_beta)
-    max_beta_log = np.log(max_beta)
-    beta_log = t * (max_beta_log - min_beta_log) + min_beta_log
-    return np.exp(beta_log)
+    # no log-space ramp starts from zero, fall back to a linear one
+    if min_beta <= 0: return max_beta * step / warmup
+    min_beta_log = math.log(min_beta)
+    max_beta_log = math.log(max_beta)
+    return math.exp(step / warmup * (max_beta_log - min_beta_log) +
+                    min_beta_log)
 
 
 def get_beta_kl_cyclic(step, cycle_size, min_beta, max_beta):
@@ -169,20 +347,40 @@ def nonsaturating_gan(score_real, score_fake):
     loss_gen = -torch.log(score_fake).mean()
     return loss_dis, loss_gen
 
+@torch.no_grad()
+@torch.no_grad()
+def reset_recurrent_state(model: nn.Module) -> nn.Module:
+    """
+    clears the streaming state written by shape probes so that it does not
+    leak into the first real call
+    """
+    for module in model.modules():
+        if hasattr(module, 'hidden_state'):
+            module.hidden_state.zero_()
+    return model
+
+
 def get_minimum_size(model):
     N = 2**15
     device = next(iter(model.parameters())).device
-    x = torch.randn(1, model.n_channels, N, requires_grad=True, device=device)
+    x = torch.zeros(1, model.n_channels, N, device=device)
     z = model.encode(x)
+    reset_recurrent_state(model)
     return int(x.shape[-1] / z.shape[-1])
 
 
 @torch.enable_grad()
 def get_rave_receptive_field(model, n_channels=1):
     N = 2**15
+    training = model.training
     model.eval()
     device = next(iter(model.parameters())).device
 
+    # only the gradient with respect to the input is needed
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    for p in model.parameters():
+        p.requires_grad_(False)
+
     for module in model.modules():
         if hasattr(module, 'gru_state') or hasattr(module, 'temporal'):
             module.disable()
@@ -206,7 +404,11 @@ def get_rave_receptive_field(model, n_channels=1):
             N *= 2
     left_receptive_field = len(left_grad[left_grad != 0])
     right_receptive_field = len(right_grad[right_grad != 0])
-    model.zero_grad()
+
+    for p, flag in zip(model.parameters(), requires_grad):
+        p.requires_grad_(flag)
+    model.train(training)
+    reset_recurrent_state(model)
 
     for module in model.modules():
         if hasattr(module, 'gru_state') or hasattr(module, 'temporal'):
@@ -217,11 +419,11 @@ def get_rave_receptive_field(model, n_channels=1):
     return left_receptive_field, right_receptive_field
 
 
-def valid_signal_crop(x, left_rf, right_rf):
+def valid_signal_crop(x, left_rf: int, right_rf: int):
     dim = x.shape[1]
-    x = x[..., left_rf.item() // dim:]
-    if right_rf.item():
-        x = x[..., :-right_rf.item() // dim]
+    x = x[..., left_rf // dim:]
+    if right_rf:
+        x = x[..., :-right_rf // dim]
     return x
 
 
@@ -252,6 +454,54 @@ def mean_difference(target: torch.Tensor,
         raise Exception(f'Norm must be either L1 or L2, got {norm}')
 
 
+class StreamPool:
+    """
+    runs independent branches of a computation on separate cuda streams so
+    that their kernels can overlap. streams are created lazily on the device
+    of the first input, and branches run sequentially on cpu.
+    """
+
+    def __init__(self, num_streams: int) -> None:
+        self.num_streams = num_streams
+        self.streams = None
+
+    def map(self, functions: Sequence[Callable[[torch.Tensor], Any]],
+            x: torch.Tensor) -> List[Any]:
+        return self.starmap(functions, [x] * len(functions))
+
+    def starmap(self, functions: Sequence[Callable[[torch.Tensor], Any]],
+                inputs: Sequence[torch.Tensor]) -> List[Any]:
+        """
+        applies each function to its own input, pairwise
+        """
+        if not inputs[0].is_cuda:
+            return [f(x) for f, x in zip(functions, inputs)]
+
+        device = inputs[0].device
+        if self.streams is None or self.streams[0].device != device:
+            self.streams = [
+                torch.cuda.Stream(device=device)
+                for _ in range(self.num_streams)
+            ]
+
+        current = torch.cuda.current_stream(device)
+        outputs = []
+        for i, (f, x) in enumerate(zip(functions, inputs)):
+            stream = self.streams[i % self.num_streams]
+            stream.wait_stream(current)
+            with torch.cuda.stream(stream):
+                x.record_stream(stream)
+                outputs.append(f(x))
+
+        for stream in self.streams:
+            current.wait_stream(stream)
+        for y in outputs:
+            for t in (y if isinstance(y, (list, tuple)) else [y]):
+                if isinstance(t, torch.Tensor):
+                    t.record_stream(current)
+        return outputs
+
+
 class MelScale(nn.Module):
 
     def __init__(self, sample_rate: int, n_fft: int, n_mels: int) -> None:
@@ -273,11 +523,13 @@ class MultiScaleSTFT(nn.Module):
                  sample_rate: int,
                  magnitude: bool = True,
                  normalized: bool = False,
-                 num_mels: Optional[int] = None) -> None:
+                 num_mels: Optional[int] = None,
+                 use_streams: bool = False) -> None:
         super().__init__()
         self.scales = scales
         self.magnitude = magnitude
         self.num_mels = num_mels
+        self.streams = StreamPool(len(scales)) if use_streams else None
 
         self.stfts = []
         self.mel_scales = []
@@ -303,20 +555,28 @@ class MultiScaleSTFT(nn.Module):
         self.stfts = nn.ModuleList(self.stfts)
         self.mel_scales = nn.ModuleList(self.mel_scales)
 
+    def _scale_forward(self, stft, mel, x: torch.Tensor) -> torch.Tensor:
+        y = stft(x)
+        if mel is not None:
+            y = mel(y)
+        if self.magnitude:
+            y = y.abs()
+        else:
+            y = torch.view_as_real(y)
+        return y
+
     def forward(self, x: torch.Tensor) -> Sequence[torch.Tensor]:
         x = rearrange(x, "b c t -> (b c) t")
-        stfts = []
-        for stft, mel in zip(self.stfts, self.mel_scales):
-            y = stft(x)
-            if mel is not None:
-                y = mel(y)
-            if self.magnitude:
-                y = y.abs()
-            else:
-                y = torch.stack([y.real, y.imag], -1)
-            stfts.append(y)
-
-        return stfts
+        scales = [
+            partial(self._scale_forward, stft, mel)
+            for stft, mel in zip(self.stfts, self.mel_scales)
+        ]
+        # ffts and mel projections stay in single precision under autocast
+        with autocast_disabled(x):
+            x = x.float()
+            if self.streams is not None:
+                return self.streams.map(scales, x)
+            return [scale(x) for scale in scales]
 
 
 class AudioDistanceV1(nn.Module):
@@ -328,16 +588,15 @@ class AudioDistanceV1(nn.Module):
         self.log_epsilon = log_epsilon
 
     def forward(self, x: torch.Tensor, y: torch.Tensor):
-        stfts_x = self.multiscale_stft(x)
-        stfts_y = self.multiscale_stft(y)
+        # both signals go through each scale in a single batch
+        stfts = self.multiscale_stft(torch.cat([x, y], 0))
         distance = 0.
 
-        for x, y in zip(stfts_x, stfts_y):
-            logx = torch.log(x + self.log_epsilon)
-            logy = torch.log(y + self.log_epsilon)
-
+        for x, y in map(lambda s: s.chunk(2, 0), stfts):
             lin_distance = mean_difference(x, y, norm='L2', relative=True)
-            log_distance = mean_difference(logx, logy, norm='L1')
+            # |log(x + eps) - log(y + eps)| computed with a single log
+            log_distance = torch.log(
+                (x + self.log_epsilon) / (y + self.log_epsilon)).abs().mean()
 
             distance = distance + lin_distance + log_distance
 
@@ -368,12 +627,11 @@ class WeightedInstantaneousSpectralDistance(nn.Module):
         return (x - np.pi).cumsum(-1)
 
     def forward(self, target: torch.Tensor, pred: torch.Tensor):
-        stfts_x = self.multiscale_stft(target)
-        stfts_y = self.multiscale_stft(pred)
+        stfts = self.multiscale_stft(torch.cat([target, pred], 0))
         spectral_distance = 0.
         phase_distance = 0.
 
-        for x, y in zip(stfts_x, stfts_y):
+        for x, y in map(lambda s: s.chunk(2, 0), stfts):
             assert x.shape[-1] == 2
 
             x = torch.view_as_complex(x)
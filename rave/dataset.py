@@ -48,7 +48,8 @@ class AudioDataset(data.Dataset):
                  db_path: str,
                  audio_key: str = 'waveform',
                  transforms: Optional[transforms.Transform] = None, 
-                 n_channels: int = 1) -> None:
+                 n_channels: int = 1,
+                 cache: bool = False) -> None:
         super().__init__()
         self._db_path = db_path
         self._audio_key = audio_key
@@ -56,25 +57,36 @@ class AudioDataset(data.Dataset):
         self._keys = None
         self._transforms = transforms
         self._n_channels = n_channels
-        lens = []
-        with self.env.begin() as txn:
-            for k in self.keys:
-               ae = AudioExample.FromString(txn.get(k)) 
-               lens.append(np.frombuffer(ae.buffers['waveform'].data, dtype=np.int16).shape)
 
+        # int16 examples read once, shared with forked dataloader workers
+        self._cache = None
+        if cache:
+            with self.env.begin() as txn:
+                self._cache = [
+                    self.read_example(txn, k)
+                    for k in tqdm(self.keys, desc='Caching dataset')
+                ]
 
     def __len__(self):
         return len(self.keys)
 
-    def __getitem__(self, index):
-        with self.env.begin() as txn:
-            ae = AudioExample.FromString(txn.get(self.keys[index]))
+    def read_example(self, txn, key) -> np.ndarray:
+        ae = AudioExample.FromString(txn.get(key))
 
         buffer = ae.buffers[self._audio_key]
         assert buffer.precision == AudioExample.Precision.INT16
 
-        audio = np.frombuffer(buffer.data, dtype=np.int16)
-        audio = audio.astype(np.float32) / (2**15 - 1)
+        return np.frombuffer(buffer.data, dtype=np.int16)
+
+    def __getitem__(self, index):
+        if self._cache is not None:
+            audio = self._cache[index]
+        else:
+            with self.env.begin() as txn:
+                audio = self.read_example(txn, self.keys[index])
+
+        audio = audio.astype(np.float32)
+        audio /= 2**15 - 1
         audio = audio.reshape(self._n_channels, -1)
 
         if self._transforms is not None:
@@ -117,13 +129,18 @@ class LazyAudioDataset(data.Dataset):
 
     def parse_dataset(self):
         items = []
-        for key in tqdm(self.keys, desc='Discovering dataset'):
-            with self.env.begin() as txn:
+        # file path and channel count of every entry, so that __getitem__
+        # does not have to read and parse the database again
+        self.sources = []
+        with self.env.begin() as txn:
+            for key in tqdm(self.keys, desc='Discovering dataset'):
                 ae = AudioExample.FromString(txn.get(key))
-            length = float(ae.metadata['length'])
-            n_signal = int(math.floor(length * self._sampling_rate))
-            n_chunks = n_signal // self._n_signal
-            items.append(n_chunks)
+                length = float(ae.metadata['length'])
+                n_signal = int(math.floor(length * self._sampling_rate))
+                n_chunks = n_signal // self._n_signal
+                items.append(n_chunks)
+                self.sources.append(
+                    (ae.metadata['path'], int(ae.metadata['channels'])))
         items = np.asarray(items)
         items = np.cumsum(items)
         self.items = items
@@ -132,21 +149,18 @@ class LazyAudioDataset(data.Dataset):
         return self.items[-1]
 
     def __getitem__(self, index):
-        audio_id = np.where(index < self.items)[0][0]
+        audio_id = np.searchsorted(self.items, index, side='right')
         if audio_id:
             index -= self.items[audio_id - 1]
 
-        key = self.keys[audio_id]
-
-        with self.env.begin() as txn:
-            ae = AudioExample.FromString(txn.get(key))
+        path, input_channels = self.sources[audio_id]
 
         audio = extract_audio(
-            ae.metadata['path'],
+            path,
             self._n_signal,
             self._sampling_rate,
             index * self._n_signal,
-            int(ae.metadata['channels']),
+            input_channels,
             self._n_channels
         )
 
@@ -211,7 +225,8 @@ def get_dataset(db_path,
                 normalize: bool = False,
                 rand_pitch: bool = False,
                 augmentations: Union[None, Iterable[Callable]] = None, 
-                n_channels: int = 1):
+                n_channels: int = 1,
+                cache: bool = False):
     if db_path[:4] == "http":
         return HTTPAudioDataset(db_path=db_path)
     with open(os.path.join(db_path, 'metadata.yaml'), 'r') as metadata:
@@ -220,8 +235,9 @@ def get_dataset(db_path,
     sr_dataset = metadata.get('sr', 44100)
     lazy = metadata['lazy']
 
+    # the casts below only copy when the signal is not already float32
     transform_list = [
-        lambda x: x.astype(np.float32),
+        lambda x: x.astype(np.float32, copy=False),
         transforms.RandomCrop(n_signal),
         transforms.RandomApply(
             lambda x: random_phase_mangle(x, 20, 2000, .99, sr_dataset),
@@ -247,7 +263,7 @@ def get_dataset(db_path,
     if augmentations:
         transform_list.extend(augmentations)
 
-    transform_list.append(lambda x: x.astype(np.float32))
+    transform_list.append(lambda x: x.astype(np.float32, copy=False))
 
     transform_list = transforms.Compose(transform_list)
 
@@ -257,7 +273,8 @@ def get_dataset(db_path,
         return AudioDataset(
             db_path,
             transforms=transform_list,
-            n_channels=n_channels
+            n_channels=n_channels,
+            cache=cache,
         )
 
 
@@ -296,6 +313,10 @@ def pole_to_z_filter(omega, amplitude=.9):
 def random_phase_mangle(x, min_f, max_f, amp, sr):
     angle = random_angle(min_f, max_f, sr)
     b, a = pole_to_z_filter(angle, amp)
+    # float32 coefficients keep lfilter from upcasting float32 signals
+    dtype = np.result_type(np.asarray(x).dtype, np.float32)
+    b = np.asarray(b, dtype=dtype)
+    a = np.asarray(a, dtype=dtype)
     return lfilter(b, a, x)
 
 def extract_audio(path: str, n_signal: int, sr: int,
@@ -330,7 +351,13 @@ def extract_audio(path: str, n_signal: int, sr: int,
         )
 
         chunk = process.communicate()[0]
-        chunk = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 2**15
-        chunk = np.concatenate([chunk, np.zeros(n_signal)], -1)
-        chunks.append(chunk)
-    return np.stack(chunks)[:, :(n_signal*2)]
+        chunks.append(np.frombuffer(chunk, dtype=np.int16))
+
+    # zero padded by n_signal and cropped to 2 * n_signal, written into a
+    # single output array
+    length = min(max(len(c) for c in chunks) + n_signal, n_signal * 2)
+    audio = np.zeros((len(chunks), length), dtype=np.float32)
+    for i, chunk in enumerate(chunks):
+        chunk = chunk[:length]
+        np.multiply(chunk, 1 / 2**15, out=audio[i, :len(chunk)])
+    return audio
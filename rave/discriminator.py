@@ -7,6 +7,7 @@ import torch.nn as nn
 import torchaudio
 
 from .blocks import normalization
+from .core import StreamPool, compile_module
 
 
 def spectrogram(n_fft: int):
@@ -76,8 +77,16 @@ class EncodecConvNet(nn.Module):
 
 class ConvNet(nn.Module):
 
-    def __init__(self, in_size, out_size, capacity, n_layers, kernel_size,
-                 stride, conv) -> None:
+    def __init__(self,
+                 in_size,
+                 out_size,
+                 capacity,
+                 n_layers,
+                 kernel_size,
+                 stride,
+                 conv,
+                 channels_last: bool = False,
+                 compile: bool = False) -> None:
         super().__init__()
         channels = [in_size]
         channels += list(capacity * 2**np.arange(n_layers))
@@ -110,7 +119,18 @@ class ConvNet(nn.Module):
 
         self.net = nn.Sequential(*net)
 
+        # only 2d convolutions (period discriminators) have an nhwc layout
+        self.channels_last = channels_last and isinstance(
+            self.net[0], nn.Conv2d)
+        if self.channels_last:
+            self.net.to(memory_format=torch.channels_last)
+
+        if compile:
+            compile_module(self)
+
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         features = []
         for layer in self.net:
             x = layer(x)
@@ -121,19 +141,29 @@ class ConvNet(nn.Module):
 
 class MultiScaleDiscriminator(nn.Module):
 
-    def __init__(self, n_discriminators, convnet, n_channels=1) -> None:
+    def __init__(self,
+                 n_discriminators,
+                 convnet,
+                 n_channels=1,
+                 use_streams: bool = False) -> None:
         super().__init__()
         layers = []
         for i in range(n_discriminators):
             layers.append(convnet(in_size=n_channels))
         self.layers = nn.ModuleList(layers)
+        self.streams = StreamPool(
+            n_discriminators) if use_streams else None
 
     def forward(self, x):
-        features = []
-        for layer in self.layers:
-            features.append(layer(x))
-            x = nn.functional.avg_pool1d(x, 2)
-        return features
+        # the downsampled signals are built upfront so that the
+        # discriminators do not depend on each other
+        pyramid = [x]
+        for _ in range(len(self.layers) - 1):
+            pyramid.append(nn.functional.avg_pool1d(pyramid[-1], 2))
+
+        if self.streams is not None:
+            return self.streams.starmap(self.layers, pyramid)
+        return [layer(x) for layer, x in zip(self.layers, pyramid)]
 
 
 class MultiScaleSpectralDiscriminator(nn.Module):
@@ -191,7 +221,8 @@ class MultiPeriodDiscriminator(nn.Module):
 
     def fold(self, x, n):
         pad = (n - (x.shape[-1] % n)) % n
-        x = nn.functional.pad(x, (0, pad))
+        if pad:
+            x = nn.functional.pad(x, (0, pad))
         return x.reshape(*x.shape[:2], -1, n)
 
 
@@ -1,6 +1,6 @@
 import math
 from time import time
-from typing import Callable, Optional, Iterable, Dict
+from typing import Callable, Optional, Iterable, Dict, Tuple
 
 import gin, pdb
 import numpy as np
@@ -8,7 +8,6 @@ import pytorch_lightning as pl
 import torch
 import torch.nn as nn
 from einops import rearrange
-from sklearn.decomposition import PCA
 from pytorch_lightning.trainer.states import RunningStage
 
 
@@ -117,7 +116,9 @@ class BetaWarmupCallback(pl.Callback):
 def _pqmf_encode(pqmf, x: torch.Tensor):
     batch_size = x.shape[:-2]
     x_multiband = x.reshape(-1, 1, x.shape[-1])
-    x_multiband = pqmf(x_multiband)
+    # the filterbank stays in single precision under autocast
+    with rave.core.autocast_disabled(x):
+        x_multiband = pqmf(x_multiband.float())
     x_multiband = x_multiband.reshape(*batch_size, -1, x_multiband.shape[-1])
     return x_multiband
 
@@ -125,7 +126,8 @@ def _pqmf_encode(pqmf, x: torch.Tensor):
 @torch.fx.wrap
 def _pqmf_decode(pqmf, x: torch.Tensor, batch_size: Iterable[int], n_channels: int):
     x = x.reshape(x.shape[0] * n_channels, -1, x.shape[-1])
-    x = pqmf.inverse(x)
+    with rave.core.autocast_disabled(x):
+        x = pqmf.inverse(x.float())
     x = x.reshape(*batch_size, n_channels, -1)
     return x
 
@@ -158,6 +160,8 @@ class RAVE(pl.LightningModule):
         input_mode: str = "pqmf",
         output_mode: str = "pqmf",
         audio_monitor_epochs: int = 1,
+        compile: bool = False,
+        gradient_checkpointing: bool = False,
         # for retro-compatibility
         enable_pqmf_encode: Optional[bool] = None,
         enable_pqmf_decode: Optional[bool] = None,
@@ -188,6 +192,11 @@ class RAVE(pl.LightningModule):
         self.decoder = decoder(n_channels=n_channels)
         self.discriminator = discriminator(n_channels=n_channels)
 
+        if compile:
+            # the pqmf is left eager, it is small and reshapes its inputs
+            for module in (self.encoder, self.decoder, self.discriminator):
+                rave.core.compile_module(module)
+
         self.audio_distance = audio_distance()
         self.multiband_audio_distance = multiband_audio_distance()
 
@@ -215,12 +224,15 @@ class RAVE(pl.LightningModule):
         self.feature_matching_fun = feature_matching_fun
         self.num_skipped_features = num_skipped_features
         self.update_discriminator_every = update_discriminator_every
+        self.gradient_checkpointing = gradient_checkpointing
 
         self.eval_number = 0
         self.beta_factor = 1.
         self.integrator = None
 
         self.register_buffer("receptive_field", torch.tensor([0, 0]).long())
+        # host copy of the receptive field, read once from the buffer
+        self._receptive_field = None
         self.audio_monitor_epochs = audio_monitor_epochs
 
     def configure_optimizers(self):
@@ -269,20 +281,43 @@ class RAVE(pl.LightningModule):
         z = self.encoder.reparametrize(z)[0]
         return self.decode(z)
 
+    def fuse_for_inference(self):
+        rave.core.remove_weight_norm(self)
+        for m in list(self.modules()):
+            if m is not self and hasattr(m, "fuse_for_inference"):
+                m.fuse_for_inference()
+        return self
+
     def on_train_batch_end(self, outputs, batch, batch_idx) -> None:
         self.lr_schedulers().step()
         return super().on_train_batch_end(outputs, batch, batch_idx)
 
+    def get_receptive_field(self) -> Tuple[int, int]:
+        if self._receptive_field is None:
+            lrf, rrf = self.receptive_field.tolist()
+            self._receptive_field = (lrf, rrf)
+        return self._receptive_field
+
+    def on_load_checkpoint(self, checkpoint) -> None:
+        self._receptive_field = None
+
+    def checkpointed_nets(self):
+        """
+        sequential bodies of the encoder and decoder, checkpointed in
+        segments when gradient checkpointing is enabled
+        """
+        encoder = getattr(self.encoder, "encoder", self.encoder)
+        nets = [getattr(m, "net", None) for m in (encoder, self.decoder)]
+        return [net for net in nets if isinstance(net, nn.Sequential)]
+
     def split_features(self, features):
         feature_real = []
         feature_fake = []
         for scale in features:
-            true, fake = zip(*map(
-                lambda x: torch.split(x, x.shape[0] // 2, 0),
-                scale,
-            ))
-            feature_real.append(true)
-            feature_fake.append(fake)
+            # the batch holds real then fake examples, slicing gives views
+            half = scale[0].shape[0] // 2
+            feature_real.append([x[:half] for x in scale])
+            feature_fake.append([x[half:] for x in scale])
         return feature_real, feature_fake
 
     def training_step(self, batch, batch_idx):
@@ -295,9 +330,16 @@ class RAVE(pl.LightningModule):
         self.encoder.set_warmed_up(self.warmed_up)
         self.decoder.set_warmed_up(self.warmed_up)
 
+        # when neither the encoder nor the decoder works on multiband
+        # signals, input and output go through the filterbank in one pass
+        joint_analysis = self.input_mode == "raw" and self.output_mode == "raw"
+
         # ENCODE INPUT
         # get multiband in case
-        z, x_multiband = self.encode(x_raw, return_mb=True)
+        if joint_analysis:
+            z = self.encode(x_raw)
+        else:
+            z, x_multiband = self.encode(x_raw, return_mb=True)
 
         z, reg = self.encoder.reparametrize(z)[:2]
         p.tick('encode')
@@ -309,23 +351,27 @@ class RAVE(pl.LightningModule):
             y_raw = _pqmf_decode(self.pqmf, y, batch_size=batch_size, n_channels=self.n_channels)
         else:
             y_raw = y 
-            y_multiband = _pqmf_encode(self.pqmf, y)
+            if not joint_analysis:
+                y_multiband = _pqmf_encode(self.pqmf, y)
 
         # TODO this has been added for training with num_samples = 65536 samples, output padding seems to mess with output dimensions. 
         # this may probably conflict with cached_conv
-        y_raw = y_raw[..., :x_raw.shape[-1]]
+        y_raw = y_raw[..., :x_raw.shape[-1]].to(x_raw)
+        if joint_analysis:
+            xy_multiband = _pqmf_encode(self.pqmf, torch.cat([x_raw, y_raw], 0))
+            x_multiband, y_multiband = xy_multiband.chunk(2, 0)
         y_multiband = y_multiband[..., :x_multiband.shape[-1]]
 
         p.tick('decode')
 
-        if self.valid_signal_crop and self.receptive_field.sum():
+        if self.valid_signal_crop and sum(self.get_receptive_field()):
             x_multiband = rave.core.valid_signal_crop(
                 x_multiband,
-                *self.receptive_field,
+                *self.get_receptive_field(),
             )
             y_multiband = rave.core.valid_signal_crop(
                 y_multiband,
-                *self.receptive_field,
+                *self.get_receptive_field(),
             )
         p.tick('crop')
 
@@ -343,46 +389,58 @@ class RAVE(pl.LightningModule):
         for k, v in fullband_distance.items():
             distances[f'fullband_{k}'] = self.weights['audio_distance'] *  v
 
-        feature_matching_distance = 0.
+        dis_step = self.warmed_up and not (batch_idx %
+                                           self.update_discriminator_every)
 
         if self.warmed_up:  # DISCRIMINATION
-            xy = torch.cat([x_raw, y_raw], 0)
+            # the discriminator update does not backpropagate into the
+            # generator, and the generator update does not compute
+            # discriminator weight gradients
+            if dis_step:
+                xy = torch.cat([x_raw, y_raw.detach()], 0)
+            else:
+                self.discriminator.requires_grad_(False)
+                xy = torch.cat([x_raw, y_raw], 0)
             features = self.discriminator(xy)
 
             feature_real, feature_fake = self.split_features(features)
 
-            loss_dis = 0
-            loss_adv = 0
-
-            pred_real = 0
-            pred_fake = 0
+            # per-scale terms are reduced once after the loop
+            feature_distances = []
+            dis_losses = []
+            adv_losses = []
 
             for scale_real, scale_fake in zip(feature_real, feature_fake):
-                current_feature_distance = sum(
-                    map(
-                        self.feature_matching_fun,
-                        scale_real[self.num_skipped_features:],
-                        scale_fake[self.num_skipped_features:],
-                    )) / len(scale_real[self.num_skipped_features:])
+                # one reduction over the per-layer distances of this scale
+                current_feature_distance = torch.stack(
+                    list(
+                        map(
+                            self.feature_matching_fun,
+                            scale_real[self.num_skipped_features:],
+                            scale_fake[self.num_skipped_features:],
+                        ))).mean()
 
-                feature_matching_distance = feature_matching_distance + current_feature_distance
+                feature_distances.append(current_feature_distance)
 
                 _dis, _adv = self.gan_loss(scale_real[-1], scale_fake[-1])
 
-                pred_real = pred_real + scale_real[-1].mean()
-                pred_fake = pred_fake + scale_fake[-1].mean()
+                dis_losses.append(_dis)
+                adv_losses.append(_adv)
 
-                loss_dis = loss_dis + _dis
-                loss_adv = loss_adv + _adv
+            feature_matching_distance = torch.stack(feature_distances).mean()
+            loss_dis = torch.stack(dis_losses).sum()
+            loss_adv = torch.stack(adv_losses).sum()
 
-            feature_matching_distance = feature_matching_distance / len(
-                feature_real)
+            # discriminator predictions are only logged
+            with torch.no_grad():
+                pred_real = torch.stack(
+                    [s[-1].mean() for s in feature_real]).sum()
+                pred_fake = torch.stack(
+                    [s[-1].mean() for s in feature_fake]).sum()
 
         else:
-            pred_real = torch.tensor(0.).to(x_raw)
-            pred_fake = torch.tensor(0.).to(x_raw)
-            loss_dis = torch.tensor(0.).to(x_raw)
-            loss_adv = torch.tensor(0.).to(x_raw)
+            # one zero built on device, without a host to device copy
+            pred_real = pred_fake = loss_dis = loss_adv = x_raw.new_zeros(())
         p.tick('discrimination')
 
         # COMPOSE GEN LOSS
@@ -390,27 +448,27 @@ class RAVE(pl.LightningModule):
         loss_gen.update(distances)
         p.tick('update loss gen dict')
 
-        if reg.item():
-            loss_gen['regularization'] = reg * self.beta_factor
+        loss_gen['regularization'] = reg * self.beta_factor
 
         if self.warmed_up:
             loss_gen['feature_matching'] = self.weights['feature_matching'] * feature_matching_distance
             loss_gen['adversarial'] = self.weights['adversarial'] * loss_adv
 
         # OPTIMIZATION
-        if not (batch_idx %
-                self.update_discriminator_every) and self.warmed_up:
-            dis_opt.zero_grad()
-            loss_dis.backward()
+        if dis_step:
+            dis_opt.zero_grad(set_to_none=True)
+            self.manual_backward(loss_dis)
             dis_opt.step()
             p.tick('dis opt')
         else:
-            gen_opt.zero_grad()
-            loss_gen_value = 0.
-            for k, v in loss_gen.items():
-                loss_gen_value += v * self.weights.get(k, 1.)
-            loss_gen_value.backward()
+            gen_opt.zero_grad(set_to_none=True)
+            loss_gen_value = torch.stack([
+                v * self.weights.get(k, 1.) for k, v in loss_gen.items()
+            ]).sum()
+            self.manual_backward(loss_gen_value)
             gen_opt.step()
+            if self.warmed_up:
+                self.discriminator.requires_grad_(True)
 
         # LOGGING
         self.log("beta_factor", self.beta_factor)
@@ -427,7 +485,7 @@ class RAVE(pl.LightningModule):
 
         z = self.encode(x)
         if isinstance(self.encoder, blocks.VariationalEncoder):
-            mean = torch.split(z, z.shape[1] // 2, 1)[0]
+            mean = z.narrow(1, 0, z.shape[1] // 2)
         else:
             mean = None
 
@@ -443,19 +501,9 @@ class RAVE(pl.LightningModule):
         return torch.cat([x, y], -1), mean
 
     def validation_epoch_end(self, out):
-        if not self.receptive_field.sum():
-            print("Computing receptive field for this configuration...")
-            lrf, rrf = rave.core.get_rave_receptive_field(self, n_channels=self.n_channels)
-            self.receptive_field[0] = lrf
-            self.receptive_field[1] = rrf
-            print(
-                f"Receptive field: {1000*lrf/self.sr:.2f}ms <-- x --> {1000*rrf/self.sr:.2f}ms"
-            )
-
         if not len(out): return
 
         audio, z = list(zip(*out))
-        audio = list(map(lambda x: x.cpu(), audio))
 
         if self.trainer.state.stage == RunningStage.SANITY_CHECKING:
             return
@@ -469,25 +517,31 @@ class RAVE(pl.LightningModule):
             self.latent_mean.copy_(z.mean(0))
             z = z - self.latent_mean
 
-            pca = PCA(z.shape[-1]).fit(z.cpu().numpy())
+            # pca through an svd of the centered latents, kept on device
+            _, S, Vh = torch.linalg.svd(z, full_matrices=False)
 
-            components = pca.components_
-            components = torch.from_numpy(components).to(z)
-            self.latent_pca.copy_(components)
+            # same sign convention as sklearn: the largest coefficient of
+            # each component is positive
+            max_idx = Vh.abs().argmax(-1, keepdim=True)
+            signs = torch.sign(torch.gather(Vh, -1, max_idx))
+            self.latent_pca.copy_(Vh * signs)
 
-            var = pca.explained_variance_ / np.sum(pca.explained_variance_)
-            var = np.cumsum(var)
+            var = S.pow(2)
+            var = torch.cumsum(var / var.sum(), 0)
 
-            self.fidelity.copy_(torch.from_numpy(var).to(self.fidelity))
+            self.fidelity.copy_(var)
 
+            # var is cumulative, so the first dimension above each threshold
+            # is found by a single sorted search
             var_percent = [.8, .9, .95, .99]
-            for p in var_percent:
-                self.log(
-                    f"fidelity_{p}",
-                    np.argmax(var > p).astype(np.float32),
-                )
-
-        y = torch.cat(audio, 0)[:8].reshape(-1).numpy()
+            thresholds = torch.tensor(var_percent).to(var)
+            dims = torch.searchsorted(var, thresholds, right=True).float()
+            for p, dim in zip(var_percent, dims):
+                self.log(f"fidelity_{p}", dim)
+
+        # only the first 8 examples are monitored, and every batch holds at
+        # least one, so the other batches are never copied to the host
+        y = torch.cat(audio[:8], 0)[:8].reshape(-1).cpu().numpy()
         if self.integrator is not None:
             y = self.integrator(y)
         self.logger.experiment.add_audio("audio_val", y, self.eval_number,
@@ -495,6 +549,24 @@ class RAVE(pl.LightningModule):
         self.eval_number += 1
 
     def on_fit_start(self):
+        # only patched for training, exported modules keep their forward
+        if self.gradient_checkpointing:
+            for net in self.checkpointed_nets():
+                rave.core.enable_gradient_checkpointing(net)
+
+        # computed once, unless restored from a checkpoint. the probe needs
+        # input gradients, so it cannot run in inference mode
+        if not sum(self.get_receptive_field()):
+            print("Computing receptive field for this configuration...")
+            lrf, rrf = rave.core.get_rave_receptive_field(self, n_channels=self.n_channels)
+            lrf, rrf = self.trainer.strategy.broadcast((lrf, rrf), 0)
+            self.receptive_field[0] = lrf
+            self.receptive_field[1] = rrf
+            self._receptive_field = (lrf, rrf)
+            print(
+                f"Receptive field: {1000*lrf/self.sr:.2f}ms <-- x --> {1000*rrf/self.sr:.2f}ms"
+            )
+
         tb = self.logger.experiment
 
         config = gin.operative_config_str()
@@ -509,3 +581,8 @@ class RAVE(pl.LightningModule):
         model = '\n'.join(model)
         tb.add_text("model", model)
 
+
+    def on_fit_end(self):
+        if self.gradient_checkpointing:
+            for net in self.checkpointed_nets():
+                rave.core.disable_gradient_checkpointing(net)
@@ -73,6 +73,7 @@ class Prior(pl.LightningModule):
             ratio = self.get_model_ratio()
             self.min_receptive_field = 2**math.ceil(math.log2(rf * ratio))
 
+    @torch.no_grad()
     def get_model_ratio(self):
         x_len = 2**14
         x = torch.zeros(1, self.n_channels, x_len)
@@ -99,6 +99,14 @@ class EuclideanCodebook(nn.Module):
         self.register_buffer("embed", embed)
         self.register_buffer("embed_avg", embed.clone())
 
+        # host-side mirror of the inited buffer, avoids a device sync on
+        # every forward once the codebook is initialized
+        self.inited_cache = False
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.inited_cache = False
+        return super()._load_from_state_dict(*args, **kwargs)
+
     @torch.jit.unused
     def init_embed_(self, data):
         embed, cluster_size = kmeans(data, self.codebook_size,
@@ -157,8 +165,10 @@ class EuclideanCodebook(nn.Module):
         shape, dtype = x.shape, x.dtype
         x = self.preprocess(x)
 
-        if not self.inited:
-            self.init_embed_(x)
+        if not self.inited_cache:
+            if not self.inited:
+                self.init_embed_(x)
+            self.inited_cache = True
 
         embed_ind = self.quantize(x)
         embed_onehot = F.one_hot(embed_ind, self.codebook_size).type(dtype)
@@ -219,6 +229,7 @@ class VectorQuantization(nn.Module):
         self.project_out = (nn.Linear(_codebook_dim, dim)
                             if requires_projection else nn.Identity())
 
+        self.requires_projection = requires_projection
         self.epsilon = epsilon
         self.commitment_weight = commitment_weight
 
@@ -258,7 +269,7 @@ class VectorQuantization(nn.Module):
         if self.training:
             quantize = x + (quantize - x).detach()
 
-        loss = torch.tensor([0.0], device=device, requires_grad=self.training)
+        loss = torch.zeros(1, device=device).requires_grad_(self.training)
 
         if self.training:
             if self.commitment_weight > 0:
@@ -279,39 +290,105 @@ class ResidualVectorQuantization(nn.Module):
         super().__init__()
         self.layers = nn.ModuleList(
             [VectorQuantization(**kwargs) for _ in range(num_quantizers)])
+        self.requires_projection = self.layers[0].requires_projection
 
-    def forward(self, x):
-        quantized_out = 0.0
-        residual = x
-
-        all_losses = []
-        all_indices = []
-
+    def codebooks(self) -> torch.Tensor:
+        embeds = []
         for layer in self.layers:
-            quantized, indices, loss = layer(residual)
-            residual = residual - quantized
-            quantized_out = quantized_out + quantized
+            embeds.append(layer._codebook.embed)
+        return torch.stack(embeds, 0)
 
-            all_indices.append(indices)
-            all_losses.append(loss)
-
-        out_losses = torch.stack(all_losses, 0).sum()
-        all_indices = torch.stack(all_indices, 1)
+    def forward(self, x):
+        if not self.training and not self.requires_projection:
+            # no codebook update nor loss needed, use the batched lookup
+            indices = self.encode(x)
+            return self.decode(indices), x.new_zeros(()), indices
+
+        num_quantizers = len(self.layers)
+
+        # allocate outputs once and fill them layer by layer
+        all_losses = x.new_zeros(num_quantizers)
+        all_indices = x.new_empty(
+            (x.shape[0], num_quantizers, x.shape[-1]),
+            dtype=torch.long,
+        )
+
+        # the first layer output seeds the sum, and the first residual is the
+        # first tensor we own
+        quantized_out, indices, loss = self.layers[0](x)
+        residual = x - quantized_out
+        all_indices[:, 0] = indices
+        all_losses[0:1] = loss
+
+        # without autograd, update the buffers we own in place
+        in_place = not torch.is_grad_enabled()
+
+        for i in range(1, num_quantizers):
+            quantized, indices, loss = self.layers[i](residual)
+            if in_place:
+                residual.sub_(quantized)
+                quantized_out.add_(quantized)
+            else:
+                residual = residual - quantized
+                quantized_out = quantized_out + quantized
+
+            all_indices[:, i] = indices
+            all_losses[i:i + 1] = loss
+
+        out_losses = all_losses.sum()
         return quantized_out, out_losses, all_indices
 
     def encode(self, x: torch.Tensor) -> torch.Tensor:
+        if not self.requires_projection:
+            return self._encode_stacked(x)
+
         residual = x
+        in_place = not torch.is_grad_enabled()
         all_indices = []
-        for layer in self.layers:
+        for i, layer in enumerate(self.layers):
             indices = layer.encode(residual)
             quantized = layer.decode(indices)
-            residual = residual - quantized
+            if in_place and i > 0:
+                residual.sub_(quantized)
+            else:
+                residual = residual - quantized
             all_indices.append(indices)
         out_indices = torch.stack(all_indices, 1)
         return out_indices
 
+    def _encode_stacked(self, x: torch.Tensor) -> torch.Tensor:
+        codebooks = self.codebooks()
+        codebooks_sq = codebooks.pow(2).sum(-1)
+        residual = x.permute(0, 2, 1)
+        in_place = not torch.is_grad_enabled()
+        all_indices = []
+        for i in range(codebooks.shape[0]):
+            embed = codebooks[i]
+            # the squared norm of the residual does not change the argmax
+            dist = 2 * residual @ embed.t() - codebooks_sq[i]
+            indices = dist.max(-1).indices
+            if in_place and i > 0:
+                residual.sub_(F.embedding(indices, embed))
+            else:
+                residual = residual - F.embedding(indices, embed)
+            all_indices.append(indices)
+        return torch.stack(all_indices, 1)
+
     def decode(self, q_indices: torch.Tensor) -> torch.Tensor:
-        quantized_out = torch.tensor(0.0, device=q_indices.device)
+        if not self.requires_projection:
+            codebooks = self.codebooks()
+            num_quantizers, codebook_size = codebooks.shape[0], codebooks.shape[1]
+            offsets = torch.arange(
+                num_quantizers,
+                device=q_indices.device,
+            ) * codebook_size
+            quantized = F.embedding(
+                q_indices + offsets.reshape(1, -1, 1),
+                codebooks.reshape(num_quantizers * codebook_size, -1),
+            )
+            return quantized.sum(1).permute(0, 2, 1)
+
+        quantized_out = torch.zeros((), device=q_indices.device)
         for i, layer in enumerate(self.layers):
             quantized = layer.decode(q_indices[:, i])
             quantized_out = quantized_out + quantized
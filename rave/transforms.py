@@ -105,9 +105,30 @@ class RandomCrop(Transform):
 class Dequantize(Transform):
     def __init__(self, bit_depth):
         self.bit_depth = bit_depth
+        self._seed = None
+        self._rng = None
+        self._noise = None
+
+    def get_rng(self):
+        # the generator is keyed on the dataloader worker so that workers,
+        # which start from copies of this transform, draw different noise
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            seed = (torch.initial_seed(), 0)
+        else:
+            seed = (worker_info.seed, worker_info.id + 1)
+        if seed != self._seed:
+            self._seed = seed
+            self._rng = np.random.default_rng(seed)
+        return self._rng
 
     def __call__(self, x: np.ndarray):
-        x += np.random.rand(*x.shape) / 2**self.bit_depth
+        dtype = np.float32 if x.dtype == np.float32 else np.float64
+        if self._noise is None or self._noise.shape != x.shape or self._noise.dtype != dtype:
+            self._noise = np.empty(x.shape, dtype=dtype)
+        noise = self.get_rng().random(dtype=dtype, out=self._noise)
+        noise *= 1 / 2**self.bit_depth
+        x += noise
         return x
 
 
@@ -142,14 +142,16 @@ class ScriptedRAVE(nn_tilde.Module):
         self.encoder = pretrained.encoder
         self.decoder = pretrained.decoder
         x_len = 2**14
-        x = torch.zeros(1, self.n_channels, x_len)
-        z = self.encode(x)
-        ratio_encode = x_len // z.shape[-1]
+        with torch.no_grad():
+            x = torch.zeros(1, self.n_channels, x_len)
+            z = self.encode(x)
+            rave.core.reset_recurrent_state(self)
+            ratio_encode = x_len // z.shape[-1]
 
-        # configure encoder
-        if (pretrained.input_mode == "pqmf") or (pretrained.output_mode == "pqmf"):
-            # scripting fails if cached conv is not initialized
-            self.pqmf(torch.zeros(1, 1, x_len))
+            # configure encoder
+            if (pretrained.input_mode == "pqmf") or (pretrained.output_mode == "pqmf"):
+                # scripting fails if cached conv is not initialized
+                self.pqmf(torch.zeros(1, 1, x_len))
 
         encode_shape = (pretrained.n_channels, 2**14) 
 
@@ -380,9 +382,8 @@ class DiscreteScriptedRAVE(ScriptedRAVE):
                         self.encoder.rvq.layers[0].codebook_size - 1).long()
         z = self.encoder.rvq.decode(z)
         if self.encoder.noise_augmentation:
-            noise = torch.randn(z.shape[0], self.encoder.noise_augmentation,
-                                z.shape[-1]).type_as(z)
-            z = torch.cat([z, noise], 1)
+            z = rave.blocks.add_noise_channels(
+                z, self.encoder.noise_augmentation)
         return z
 
 
@@ -393,9 +394,8 @@ class WasserteinScriptedRAVE(ScriptedRAVE):
 
     def pre_process_latent(self, z):
         if self.encoder.noise_augmentation:
-            noise = torch.randn(z.shape[0], self.encoder.noise_augmentation,
-                                z.shape[-1]).type_as(z)
-            z = torch.cat([z, noise], 1)
+            z = rave.blocks.add_noise_channels(
+                z, self.encoder.noise_augmentation)
         return z
 
 
@@ -415,9 +415,11 @@ class TraceModel(nn.Module):
         self.pretrained = pretrained
         self.latent_size = pretrained.latent_size
 
-        x = torch.zeros(1, self.pretrained.n_channels, 2**14)
-        z = model.encode(x)
-        z = pretrained.post_process_latent(z)
+        with torch.no_grad():
+            x = torch.zeros(1, self.pretrained.n_channels, 2**14)
+            z = model.encode(x)
+            rave.core.reset_recurrent_state(model)
+            z = pretrained.post_process_latent(z)
         self.ratio = x.shape[-1] // z.shape[-1]
 
         # self.register_buffer(
@@ -491,6 +493,7 @@ def get_state_dict(RUN, PRIOR):
 
 def main(argv):
     cc.use_cached_conv(FLAGS.streaming)
+    rave.core.use_torch_compile(False)
 
     logging.info("building rave")
 
@@ -558,9 +561,7 @@ def main(argv):
             prior_scripted = TraceModel(prior_pretrained, pretrained)
 
 
-    for m in pretrained.modules():
-        if hasattr(m, "weight_g"):
-            nn.utils.remove_weight_norm(m)
+    pretrained.fuse_for_inference()
 
     logging.info("script model")
     scripted_rave = script_class(
@@ -572,6 +573,7 @@ def main(argv):
     )
     z = scripted_rave.encode(x)
     x = scripted_rave.decode(z)
+    rave.core.reset_recurrent_state(scripted_rave)
 
     logging.info("save model")
     output = FLAGS.output or os.path.dirname(FLAGS.run)
@@ -25,9 +25,7 @@ def main(argv):
     pretrained.load_state_dict(torch.load(checkpoint)["state_dict"])
     pretrained.eval()
 
-    for m in pretrained.modules():
-        if hasattr(m, "weight_g"):
-            nn.utils.remove_weight_norm(m)
+    pretrained.fuse_for_inference()
 
     def recursive_replace(model: nn.Module):
         for name, child in model.named_children():
@@ -2,6 +2,7 @@ from absl import app, flags, logging
 import pdb
 import torch, torchaudio, argparse, os, tqdm, re, gin
 import cached_conv as cc
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import rave
@@ -30,6 +31,25 @@ def get_audio_files(path):
     return audio_files
 
 
+def to_host(x):
+    # starts the device to host copy without blocking, and returns an event
+    # the writer has to wait on before reading the buffer
+    x = x.detach()
+    if x.device.type != "cuda":
+        return x, None
+    buffer = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+    buffer.copy_(x, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record()
+    return buffer, event
+
+
+def save_audio(path, x, event, sr):
+    if event is not None:
+        event.synchronize()
+    torchaudio.save(path, x, sample_rate=sr)
+
+
 def main(argv):
     torch.set_float32_matmul_precision('high')
     cc.use_cached_conv(FLAGS.stream)
@@ -77,6 +97,10 @@ def main(argv):
     progress_bar = tqdm.tqdm(audio_files)
     cc.MAX_BATCH_SIZE = 8
 
+    # files are written in the background while the next one is processed
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending = None
+
     for i, (d, f) in enumerate(progress_bar):
         #TODO reset cache
             
@@ -120,7 +144,14 @@ def main(argv):
         out_path = re.sub(d, "", f)
         out_path = os.path.join(FLAGS.out_path, f)
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        torchaudio.save(out_path, out[0].cpu(), sample_rate=model.sr)
+        out, event = to_host(out[0])
+        if pending is not None:
+            pending.result()
+        pending = writer.submit(save_audio, out_path, out, event, model.sr)
+
+    if pending is not None:
+        pending.result()
+    writer.shutdown()
 
 if __name__ == "__main__": 
     app.run(main)
\ No newline at end of file
@@ -64,6 +64,9 @@ flags.DEFINE_bool('derivative',
 flags.DEFINE_bool('normalize',
                   default=False,
                   help='Train RAVE on normalized signals')
+flags.DEFINE_bool('cache',
+                  default=False,
+                  help='Keep the whole dataset in memory (non lazy datasets)')
 flags.DEFINE_list('rand_pitch',
                   default=None,
                   help='activates random pitch')
@@ -73,6 +76,13 @@ flags.DEFINE_float('ema',
 flags.DEFINE_bool('progress',
                   default=True,
                   help='Display training progress bar')
+flags.DEFINE_string('precision',
+                    default='32',
+                    help='Training precision (32, 16 or bf16)')
+flags.DEFINE_enum('profiler',
+                  default=None,
+                  enum_values=['simple', 'advanced'],
+                  help='Lightning profiler to use (disabled by default)')
 flags.DEFINE_bool('smoke_test', 
                   default=False,
                   help="Run training with n_batches=1 to test the model")
@@ -167,19 +177,55 @@ def main(argv):
                                        derivative=FLAGS.derivative,
                                        normalize=FLAGS.normalize,
                                        rand_pitch=FLAGS.rand_pitch,
-                                       n_channels=n_channels)
+                                       n_channels=n_channels,
+                                       cache=FLAGS.cache)
     train, val = rave.dataset.split_dataset(dataset, 98)
 
+    if FLAGS.gpu == [-1]:
+        gpu = 0
+    else:
+        gpu = FLAGS.gpu or rave.core.setup_gpu()
+
+    print('selected gpu:', gpu)
+
+    accelerator = None
+    devices = None
+    if FLAGS.gpu == [-1]:
+        pass
+    elif torch.cuda.is_available():
+        accelerator = "cuda"
+        devices = FLAGS.gpu or rave.core.setup_gpu()
+    elif torch.backends.mps.is_available():
+        print(
+            "Training on mac is not available yet. Use --gpu -1 to train on CPU (not recommended)."
+        )
+        exit()
+        accelerator = "mps"
+        devices = 1
+
     # get data-loader
     num_workers = FLAGS.workers
     if os.name == "nt" or sys.platform == "darwin":
         num_workers = 0
+    loader_options = {}
+    if num_workers > 0:
+        loader_options["persistent_workers"] = True
+        loader_options["prefetch_factor"] = 4
+    # page-locked batches only speed up host to cuda copies
+    pin_memory = accelerator == "cuda"
     train = DataLoader(train,
                        FLAGS.batch,
                        True,
                        drop_last=True,
-                       num_workers=num_workers)
-    val = DataLoader(val, FLAGS.batch, False, num_workers=num_workers)
+                       num_workers=num_workers,
+                       pin_memory=pin_memory,
+                       **loader_options)
+    val = DataLoader(val,
+                     FLAGS.batch,
+                     False,
+                     num_workers=num_workers,
+                     pin_memory=pin_memory,
+                     **loader_options)
 
     # CHECKPOINT CALLBACKS
     validation_checkpoint = pl.callbacks.ModelCheckpoint(monitor="validation",
@@ -203,29 +249,21 @@ def main(argv):
 
     RUN_NAME = f'{FLAGS.name}_{gin_hash}'
 
-    os.makedirs(os.path.join(FLAGS.out_path, RUN_NAME), exist_ok=True)
+    # only the main process writes to the run folder
+    is_main_process = int(os.environ.get("LOCAL_RANK", 0)) == 0
 
-    if FLAGS.gpu == [-1]:
-        gpu = 0
-    else:
-        gpu = FLAGS.gpu or rave.core.setup_gpu()
+    if is_main_process:
+        os.makedirs(os.path.join(FLAGS.out_path, RUN_NAME), exist_ok=True)
 
-    print('selected gpu:', gpu)
+    # one process per gpu when training on several of them
+    distributed = {}
+    if accelerator == "cuda" and len(devices) > 1:
+        distributed["strategy"] = "ddp"
+        distributed["sync_batchnorm"] = True
 
-    accelerator = None
-    devices = None
-    if FLAGS.gpu == [-1]:
-        pass
-    elif torch.cuda.is_available():
-        accelerator = "cuda"
-        devices = FLAGS.gpu or rave.core.setup_gpu()
-    elif torch.backends.mps.is_available():
-        print(
-            "Training on mac is not available yet. Use --gpu -1 to train on CPU (not recommended)."
-        )
-        exit()
-        accelerator = "mps"
-        devices = 1
+    precision = FLAGS.precision
+    if precision.isdigit():
+        precision = int(precision)
 
     callbacks = [
         validation_checkpoint,
@@ -249,8 +287,10 @@ def main(argv):
         callbacks=callbacks,
         max_epochs=300000,
         max_steps=FLAGS.max_steps,
-        profiler="simple",
+        precision=precision,
+        profiler=FLAGS.profiler,
         enable_progress_bar=FLAGS.progress,
+        **distributed,
         **val_check,
     )
 
@@ -262,8 +302,9 @@ def main(argv):
         trainer.fit_loop.epoch_loop._batches_that_stepped = loaded['global_step']
         # model = model.load_state_dict(loaded['state_dict'])
     
-    with open(os.path.join(FLAGS.out_path, RUN_NAME, "config.gin"), "w") as config_out:
-        config_out.write(gin.operative_config_str())
+    if is_main_process:
+        with open(os.path.join(FLAGS.out_path, RUN_NAME, "config.gin"), "w") as config_out:
+            config_out.write(gin.operative_config_str())
 
     trainer.fit(model, train, val, ckpt_path=run)
 
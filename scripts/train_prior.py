@@ -63,6 +63,8 @@ def add_gin_extension(config_name: str) -> str:
 
 
 def main(argv):
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cudnn.benchmark = True
 
     # load pretrained RAVE
     config_file = rave.core.search_for_config(FLAGS.model) 
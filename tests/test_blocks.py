@@ -0,0 +1,94 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from rave.blocks import GRU, Encoder, read_noise_buffer
+from rave.core import reset_recurrent_state
+
+
+def test_noise_buffer_wraps_around():
+    buffer = torch.arange(10).float()
+    pointer = [0]
+
+    noise = read_noise_buffer(buffer, pointer, [2, 3])
+    assert torch.equal(noise, buffer[:6].reshape(2, 3))
+    assert pointer == [6]
+
+    noise = read_noise_buffer(buffer, pointer, [6])
+    assert torch.equal(noise, torch.tensor([6., 7., 8., 9., 0., 1.]))
+    assert pointer == [2]
+
+
+def test_noise_buffer_too_small():
+    with pytest.raises(RuntimeError):
+        read_noise_buffer(torch.zeros(4), [0], [2, 3])
+
+
+def test_fold_batch_norm():
+    encoder = Encoder(
+        data_size=16,
+        capacity=8,
+        latent_size=4,
+        ratios=[2, 2],
+        n_out=1,
+        sample_norm=False,
+        repeat_layers=2,
+    )
+    with torch.no_grad():
+        for module in encoder.modules():
+            if isinstance(module, nn.BatchNorm1d):
+                module.running_mean.normal_()
+                module.running_var.uniform_(.5, 2)
+                module.weight.normal_()
+                module.bias.normal_()
+    encoder.eval()
+
+    x = torch.randn(2, 16, 64)
+    with torch.no_grad():
+        target = encoder(x)
+        output = encoder.fuse_for_inference()(x)
+
+    assert not any(isinstance(m, nn.BatchNorm1d) for m in encoder.modules())
+    assert sum(isinstance(m, nn.Identity) for m in encoder.net) == 4
+    assert torch.allclose(output, target, atol=1e-4, rtol=1e-4)
+
+
+def streaming_gru():
+    gru = GRU(latent_size=4, num_layers=2)
+    gru.streaming = True
+    return gru
+
+
+def test_gru_pads_to_state_batch():
+    gru = streaming_gru()
+    max_batch_size = gru.hidden_state.shape[1]
+    x = torch.randn(3, 4, 16)
+
+    with torch.no_grad():
+        output = gru(x)
+        target = gru.gru(x.permute(0, 2, 1))[0].permute(0, 2, 1)
+
+    assert output.shape == x.shape
+    assert gru.hidden_state.shape[1] == max_batch_size
+    assert torch.allclose(output, target, atol=1e-5)
+
+
+def test_gru_batch_too_large():
+    gru = streaming_gru()
+    x = torch.randn(gru.hidden_state.shape[1] + 1, 4, 16)
+    with pytest.raises(RuntimeError):
+        gru(x)
+
+
+def test_gru_carries_state():
+    gru = streaming_gru()
+    x = torch.randn(2, 4, 32)
+
+    with torch.no_grad():
+        target = gru.gru(x.permute(0, 2, 1))[0].permute(0, 2, 1)
+        output = torch.cat([gru(chunk) for chunk in x.chunk(4, -1)], -1)
+
+    assert torch.allclose(output, target, atol=1e-5)
+
+    reset_recurrent_state(gru)
+    assert not gru.hidden_state.any()
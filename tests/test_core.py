@@ -0,0 +1,88 @@
+import copy
+
+import numpy as np
+import pytest
+import torch
+import torch.fft as fft
+import torch.nn as nn
+
+from rave.core import (amp_to_impulse_response, disable_gradient_checkpointing,
+                       enable_gradient_checkpointing, fft_convolve,
+                       get_beta_kl)
+
+
+def reference_impulse_response(amp, target_size):
+    amp = fft.irfft(torch.view_as_complex(
+        torch.stack([amp, torch.zeros_like(amp)], -1)))
+    filter_size = amp.shape[-1]
+    amp = torch.roll(amp, filter_size // 2, -1)
+    amp = amp * torch.hann_window(filter_size, dtype=amp.dtype)
+    amp = nn.functional.pad(amp, (0, target_size - filter_size))
+    return torch.roll(amp, -filter_size // 2, -1)
+
+
+@pytest.mark.parametrize("noise_bands,target_size", [(5, 8), (5, 64),
+                                                      (17, 16), (9, 512)])
+def test_impulse_response(noise_bands, target_size):
+    amp = torch.rand(2, 10, 3, noise_bands)
+    target = reference_impulse_response(amp, target_size)
+
+    ir = amp_to_impulse_response(amp, target_size)
+    assert torch.allclose(ir, target, atol=1e-6)
+
+    filter_size = 2 * (noise_bands - 1)
+    window = torch.roll(torch.hann_window(filter_size), filter_size // 2)
+    ir = amp_to_impulse_response(amp, target_size, window)
+    assert torch.allclose(ir, target, atol=1e-6)
+
+
+def reference_convolve(signal, kernel):
+    # causal linear convolution truncated to the signal length
+    size = signal.shape[-1]
+    signal = signal.reshape(-1, size).double().numpy()
+    kernel = kernel.reshape(-1, size).double().numpy()
+    output = np.stack([np.convolve(s, k)[:size] for s, k in zip(signal, kernel)])
+    return torch.from_numpy(output).float()
+
+
+@pytest.mark.parametrize("size", [8, 63, 64, 65, 256])
+@pytest.mark.parametrize("max_direct_size", [0, 64])
+def test_fft_convolve(size, max_direct_size):
+    signal = torch.randn(2, 10, 3, size)
+    kernel = torch.randn(2, 10, 3, size)
+
+    target = reference_convolve(signal, kernel).reshape(signal.shape)
+    output = fft_convolve(signal, kernel, max_direct_size=max_direct_size)
+    assert torch.allclose(output, target, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("segments", [1, 2, 3])
+def test_gradient_checkpointing(segments):
+    layers = []
+    for _ in range(3):
+        layers += [nn.Conv1d(4, 4, 3, padding=1), nn.BatchNorm1d(4), nn.ReLU()]
+    target_net = nn.Sequential(*layers)
+    net = enable_gradient_checkpointing(copy.deepcopy(target_net), segments)
+
+    x = torch.randn(2, 4, 32)
+    target_net(x).pow(2).sum().backward()
+    net(x).pow(2).sum().backward()
+
+    for p, target_p in zip(net.parameters(), target_net.parameters()):
+        assert torch.allclose(p.grad, target_p.grad, atol=1e-5)
+
+    for bn, target_bn in zip(net[1::3], target_net[1::3]):
+        assert bn.num_batches_tracked.item() == 1
+        assert torch.allclose(bn.running_mean, target_bn.running_mean)
+        assert torch.allclose(bn.running_var, target_bn.running_var)
+
+    disable_gradient_checkpointing(net)
+    assert "forward" not in net.__dict__
+
+
+@pytest.mark.parametrize("min_beta", [0, 1e-6])
+def test_beta_kl(min_beta):
+    assert get_beta_kl(0, 100, min_beta, .1) == pytest.approx(min_beta)
+    assert min_beta < get_beta_kl(50, 100, min_beta, .1) < .1
+    assert get_beta_kl(100, 100, min_beta, .1) == pytest.approx(.1)
+    assert get_beta_kl(200, 100, min_beta, .1) == .1
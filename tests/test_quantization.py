@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from rave.quantization import ResidualVectorQuantization
+
+configs = [(1, 16), (4, 64)]
+
+
+@pytest.mark.parametrize("num_quantizers,codebook_size", configs)
+def test_stacked_rvq(num_quantizers, codebook_size):
+    rvq = ResidualVectorQuantization(
+        num_quantizers,
+        dim=8,
+        codebook_size=codebook_size,
+        kmeans_init=False,
+    )
+    for layer in rvq.layers:
+        layer._codebook.embed.normal_()
+    rvq.eval()
+
+    x = torch.randn(2, 8, 32)
+
+    residual = x
+    target_indices = []
+    target_quantized = torch.zeros_like(x)
+    for layer in rvq.layers:
+        indices = layer.encode(residual)
+        quantized = layer.decode(indices)
+        residual = residual - quantized
+        target_indices.append(indices)
+        target_quantized = target_quantized + quantized
+    target_indices = torch.stack(target_indices, 1)
+
+    indices = rvq.encode(x)
+    assert torch.equal(indices, target_indices)
+    assert torch.allclose(rvq.decode(indices), target_quantized, atol=1e-5)
+
+    quantized, loss, indices = rvq(x)
+    assert torch.equal(indices, target_indices)
+    assert torch.allclose(quantized, target_quantized, atol=1e-5)
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+from rave.transforms import Dequantize
+
+
+@pytest.mark.parametrize("bit_depth", [8, 16])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_dequantize(bit_depth, dtype):
+    x = np.random.uniform(-1, 1, (2, 1024)).astype(dtype)
+    target = x.copy()
+
+    output = Dequantize(bit_depth)(x)
+    assert output.dtype == dtype
+    assert np.all(np.abs(output - target) <= 1 / 2**bit_depth)